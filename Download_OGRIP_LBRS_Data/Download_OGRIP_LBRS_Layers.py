@@ -40,18 +40,31 @@ import sys
 import subprocess
 import shutil
 import time
+import hashlib
+import json
+import random
+import sqlite3
+import threading
 import ogr
+import osr
 import pathlib
+import struct
 
-# From what I can find, requests is a spin of urllib.request or maybe just urllib. It's a little unclear to me, 
-# but the language between the two do not seem to be shared and I haven't the time right now to dig out the equities
-# to reduce it down to just one library.  So we're using both until then. :/
+# Only needed for inproc_reproject. Without it, layers are reprojected by ogr2ogr as before.
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+# All web requests go through one requests session (see HTTP VARIABLES and http_request) so connections, timeouts and
+# retries are shared.
 import requests
-from urllib import request
 
 from datetime import datetime
 from zipfile import ZipFile
-from io import BytesIO
+from tempfile import TemporaryFile
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 
 # For error catching
 from inspect import currentframe, getframeinfo
@@ -117,6 +130,28 @@ use_arch_db = 1
 limit_features = 0
 
 
+# If set to a value greater than 0, the number of minutes the run has to finish in. Layers are worked on in order of
+# expected cost from previous runs (see schedule_layers), and layers that have probably not changed since the last run
+# are deferred to the next run once the time left can't cover them. Layers likely to have changed are never deferred.
+# If set to 0, all layers are worked on regardless of time.
+time_budget = 0
+
+
+# Default is 1.
+# If set to 1, and any layers were updated, compacts the GeoPackage before it is sent to the archive location: rebuilds
+#	the spatial indexes, refreshes the gpkg_contents extents, runs ANALYZE and VACUUMs into a fresh file using
+#	optimize_page_size. Skipped if time_budget is set and fewer than optimize_reserve minutes are left.
+# If set to 0, the GeoPackage is sent as is.
+optimize_gpkg = 1
+optimize_page_size = 16384
+optimize_reserve = 10
+
+
+# Number of prior versions of the archived GeoPackage to keep in a generations folder beside it when a new one is
+# published. If set to 0, prior versions are not kept.
+db_generations = 3
+
+
 
 
 ##############################
@@ -138,6 +173,10 @@ db_arch_loc = f"{home}/Drives/S/GIS Data/OGRIP"
 # GeoPackage name
 db = r'OGRIP_LBRS.gpkg'
 
+# Download sizes and durations from previous runs for schedule_layers. Kept beside the workspace rather than in the
+# GeoPackage so the published db only changes when the data does.
+run_history_file = f'{db_ws_loc}/run_history.json'
+
 # Directs the Python script to operate within the workspace location
 os.chdir(db_ws_loc)
 
@@ -171,6 +210,48 @@ layer_types = ['ADDS', 'CL', 'INTRSCTS', 'LNDMRKS', 'RLXING']
 # Overwrites above. Most commonly requested, but modify as desired or preface line below with # for all layer types:
 layer_types = ['ADDS', 'CL']
 
+# ODOT county boundaries service. Only the fields used by this script are requested, a page at a time, already in t_srs.
+odot_counties_url = 'https://gis.dot.state.oh.us/arcgis/rest/services/TIMS/Boundaries/MapServer/2/query'
+odot_counties_fields = 'COUNTY_CD'
+odot_counties_page_size = 25
+
+# The fetched boundaries are kept here so building a fresh database doesn't need the ODOT service. The copy is fetched
+# again once it is older than odot_counties_cache_days or no longer holds every county in t_srs.
+odot_counties_cache = f'{db_ws_loc}/odot_counties.json'
+odot_counties_cache_days = 90
+
+
+
+
+########################
+#    HTTP VARIABLES    #
+########################
+
+# Seconds to wait on a connection or read before giving up on an attempt.
+http_timeout = 60
+
+# Times a failed request (connection error, timeout or a 429/5xx response) is retried before giving up. Each retry waits
+# a random time of up to http_backoff seconds, doubled for every attempt, so retries don't all land at once.
+http_retries = 4
+http_backoff = 2
+
+# Most requests open to a single host at a time. Connections are kept alive and reused between requests.
+http_max_per_host = 4
+
+http_session = requests.Session()
+http_adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=http_max_per_host)
+http_session.mount('http://', http_adapter)
+http_session.mount('https://', http_adapter)
+
+http_host_slots = {}
+http_lock = threading.Lock()
+http_metrics = {'requests': 0, 'retries': 0, 'failures': 0, 'bytes': 0, 'seconds': 0.0}
+
+# Matching settings for GDAL's /vsicurl reads within ogr2ogr.
+gdal_http_config = (f'--config GDAL_HTTP_TIMEOUT {http_timeout} --config GDAL_HTTP_MAX_RETRY {http_retries} '
+	f'--config GDAL_HTTP_RETRY_DELAY {http_backoff} --config GDAL_HTTP_MULTIPLEX YES --config GDAL_HTTP_TCP_KEEPALIVE YES '
+	'--config GDAL_DISABLE_READDIR_ON_OPEN EMPTY_DIR --config CPL_VSIL_CURL_ALLOWED_EXTENSIONS .zip')
+
 
 
 
@@ -192,6 +273,20 @@ crs3735 = ['BUT_CL', 'CLA_CL', 'CLE_CL', 'CLI_CL', 'FAI_CL', 'FRA_CL', 'GRE_CL',
 # 32122 S half and assigned 32123 by mistake.
 crs32122 = ['HAR_CL', 'POR_CL']
 
+# Default is 0. Left off until bench_reproject (below) shows the in-process path beating ogr2ogr on a large layer.
+# If set to 1, layers needing reprojection are imported by ogr2ogr in their source SRS and then reprojected within this
+#	script (see reproject_layer), reusing one coordinate transformation per source SRS for the whole run and
+#	transforming reproject_batch features' worth of coordinates at a time. Requires numpy.
+# If set to 0, or numpy is not available, ogr2ogr reprojects each layer.
+inproc_reproject = 0
+reproject_batch = 10000
+
+# Set to a layer name (e.g. 'FRA_ADDS') to compare the per-feature cost of reprojecting that layer by ogr2ogr and by
+# reproject_layer in a scratch GeoPackage. No further actions are taken. Leave as '' for normal runs.
+bench_reproject = ''
+
+transform_cache = {}
+
 
 
 
@@ -209,6 +304,15 @@ updates_list = []
 empty_tables_list = []
 geom_mismatch_list = []
 missing_src_list = []
+deferred_list = []
+run_history = {}
+dedupe_list = []
+
+# Used with time_budget to tell how much of the run is left.
+run_start = time.time()
+
+# Fallback cost estimate in seconds per byte of download for layers with no import history yet. ~1s per MB.
+default_secs_per_byte = 1 / (1000 * 1000)
 
 
 
@@ -242,8 +346,9 @@ def get_src_data(c_list=county_list, t_list=layer_types):
 					print(f'Importing {layer_name}.prj - {datetime.now().strftime("%T")}')
 					
 					# Extract prj file from online.zip
-					with request.urlopen(url) as zipurl:
-						with ZipFile(BytesIO(zipurl.read())) as zfile:
+					with TemporaryFile() as zipurl:
+						http_request('GET', url, dest=zipurl)
+						with ZipFile(zipurl) as zfile:
 							for fileName in zfile.namelist():
 							   if fileName.endswith(f'{layer_name}.prj'):
 								   zfile.extract(fileName, f'{db_ws_loc}/PRJs/')
@@ -251,7 +356,8 @@ def get_src_data(c_list=county_list, t_list=layer_types):
 					print('Downloading raw data.')
 					if not os.path.exists(f'{db_ws_loc}/raw'):
 						os.mkdir(f'{db_ws_loc}/raw')
-					urllib.request.urlretrieve(url, f'{db_ws_loc}/raw/{layer_name}.zip') 
+					with open(f'{db_ws_loc}/raw/{layer_name}.zip', 'wb') as rawzip:
+						http_request('GET', url, dest=rawzip)
 
 			else:
 				print(f"Source for {layer_name} not available.")
@@ -307,8 +413,8 @@ def create_new_db():
 		# os.system(r'cd %s && wget -N "https://github.com/opengeospatial/ets-gpkg10/raw/master/src/test/resources/gpkg/empty.gpkg" && cp empty.gpkg %s' % (db_ws_loc, db))
 		# url = "https://github.com/opengeospatial/ets-gpkg10/raw/master/src/test/resources/gpkg/empty.gpkg"
 		url = "http://www.geopackage.org/data/empty.gpkg"
-		empty_gpkg = requests.get(url)
-		open(f'{db_ws_loc}/empty.gpkg', 'wb').write(empty_gpkg.content)
+		with open(f'{db_ws_loc}/empty.gpkg', 'wb') as empty_gpkg:
+			http_request('GET', url, dest=empty_gpkg)
 		os.rename(f'{db_ws_loc}/empty.gpkg', f'{db_ws_loc}/{db}')
 		if os.path.exists(f'{db_ws_loc}/{db}'):
 			print(f'Fresh {db} created from new template.')
@@ -331,123 +437,374 @@ def create_new_db():
 		run_sql(getframeinfo(currentframe()).lineno,sql=sql)[0]
 
 
-# Reprojects and downloads ODOT counties layer to the db.
+# Reprojects and imports the ODOT counties layer to the db from the local copy, fetching a new one first if needed.
 def get_odot_counties_layer():
-	# In case you're comparing to the odot download file, the geom restriction isn't necessary because we're only dealing with 88 features.
-	cmd = f'ogr2ogr -f "GPKG" -update -append -skipfailures -gt 20000 -ds_transaction -unsetFieldWidth -nln "county" -preserve_fid -geomfield "geom" -t_srs EPSG:3734 "{db_ws_loc}/{db}" "https://gis.dot.state.oh.us/arcgis/rest/services/TIMS/Boundaries/MapServer/2/query?where=1%3D1&text=&objectIds=&time=&geometry=&geometryType=esriGeometryPolygon&inSR=4326&spatialRel=esriSpatialRelIntersects&relationParam=&outFields=*&returnGeometry=true&returnTrueCurves=true&maxAllowableOffset=&geometryPrecision=&outSR=&returnIdsOnly=false&returnCountOnly=false&orderByFields=&groupByFieldsForStatistics=&outStatistics=&returnZ=false&returnM=false&gdbVersion=&returnDistinctValues=false&resultOffset=&resultRecordCount=&queryByDistance=&returnExtentsOnly=false&datumTransformation=&parameterValues=&rangeValues=&f=pjson" OGRGeoJSON && echo "County file import complete."'
-	
 	print(f'Importing ODOT county layer - {datetime.now().strftime("%T")}')
+	if not odot_counties_cache_valid():
+		try:
+			fetch_odot_counties()
+		except Exception as e:
+			print(f'ODOT Counties layer dowload failed.')
+			errorcatch(e, {getframeinfo(currentframe()).lineno})
+			if not os.path.exists(odot_counties_cache):
+				omission_list.append(f'odot.county')
+				return
+			print('Using the existing local copy.')
+
+	cmd = f'ogr2ogr -f "GPKG" -update -append -skipfailures -gt 20000 -ds_transaction -unsetFieldWidth -nln "county" -geomfield "geom" -t_srs EPSG:{t_srs} "{db_ws_loc}/{db}" "{odot_counties_cache}" && echo "County file import complete."'
 	try:
 		subprocess.Popen(cmd, shell=True).wait()
 	except Exception as e:
-		print(f'ODOT Counties layer dowload failed.')
+		print(f'ODOT Counties layer import failed.')
 		omission_list.append(f'odot.county')
 		errorcatch(e, {getframeinfo(currentframe()).lineno})
 
 
-# Cycles through the county_list and layer_types and manages the downloads and file manipulations.
+# Checks the local copy of the ODOT counties layer is recent, readable and holds every county in t_srs.
+def odot_counties_cache_valid():
+	if not os.path.exists(odot_counties_cache):
+		return False
+
+	age_days = (time.time() - os.path.getmtime(odot_counties_cache)) / (24 * 60 * 60)
+	if age_days > odot_counties_cache_days:
+		print(f'Local ODOT counties copy is {age_days:.0f} days old.')
+		return False
+
+	try:
+		with open(odot_counties_cache, 'r') as cache:
+			counties = json.load(cache)
+		srs = counties['spatialReference']
+		county_cds = set(feat['attributes']['COUNTY_CD'] for feat in counties['features'] if feat.get('geometry'))
+	except Exception as e:
+		print('Local ODOT counties copy is unreadable.')
+		errorcatch(e, {getframeinfo(currentframe()).lineno})
+		return False
+
+	if t_srs not in (str(srs.get('wkid')), str(srs.get('latestWkid'))):
+		print(f'Local ODOT counties copy is not in EPSG:{t_srs}.')
+		return False
+	if not set(all_counties).issubset(county_cds):
+		print(f'Local ODOT counties copy is missing counties: {sorted(set(all_counties) - county_cds)}')
+		return False
+
+	print('Using local ODOT counties copy.')
+	return True
+
+
+# Pages through the ODOT counties service concurrently and saves the combined Esri JSON to odot_counties_cache. This
+# doesn't rely on the server returning every county in one response.
+def fetch_odot_counties():
+	print(f'Fetching ODOT counties - {datetime.now().strftime("%T")}')
+	response = http_request('GET', odot_counties_url, params={'where': '1=1', 'returnCountOnly': 'true', 'f': 'json'})
+	response.raise_for_status()
+	count = response.json()['count']
+
+	def get_page(offset):
+		params = {
+			'where': '1=1',
+			'outFields': odot_counties_fields,
+			'returnGeometry': 'true',
+			'outSR': t_srs,
+			'orderByFields': 'COUNTY_CD',
+			'resultOffset': offset,
+			'resultRecordCount': odot_counties_page_size,
+			'f': 'json',
+		}
+		response = http_request('GET', odot_counties_url, params=params)
+		response.raise_for_status()
+		page = response.json()
+		if 'error' in page:
+			raise Exception(page['error'])
+		return page
+
+	with ThreadPoolExecutor(max_workers=4) as pool:
+		pages = list(pool.map(get_page, range(0, count, odot_counties_page_size)))
+
+	counties = pages[0]
+	for page in pages[1:]:
+		counties['features'].extend(page['features'])
+	counties.pop('exceededTransferLimit', None)
+	if len(counties['features']) != count:
+		raise Exception(f"Expected {count} counties, received {len(counties['features'])}.")
+
+	with open(f'{odot_counties_cache}.tmp', 'w') as cache:
+		json.dump(counties, cache)
+	os.replace(f'{odot_counties_cache}.tmp', odot_counties_cache)
+	print(f'{count} ODOT counties saved to {odot_counties_cache}.')
+
+
+# Works through the county_list and layer_types in the order given by schedule_layers and manages the downloads and file
+# manipulations. Records how long each layer took for the next run's schedule.
 def get_data():
-	for county in county_list:
+	prep_shp_hashes()
+	jobs = schedule_layers()
+
+	for job in jobs:
+		layer_name = job['layer_name']
 		print('')
-		print(county)
-		for layer_type in layer_types:
-			layer_name = f'{county}_{layer_type}'
-			
-			url = f'http://gis3.oit.ohio.gov/LBRS/_downloads/{layer_name}.zip'
-			url = url_check(url)
+		print(layer_name)
 
-			if url is None:
-				print(f"Source missing for {layer_name}. Line No.: {getframeinfo(currentframe()).lineno}")
-				omission_list.append(layer_name)
-				missing_src_list.append(layer_name)
+		if job['url'] is None:
+			print(f"Source missing for {layer_name}. Line No.: {getframeinfo(currentframe()).lineno}")
+			omission_list.append(layer_name)
+			missing_src_list.append(layer_name)
+		else:
+			remaining = time_budget * 60 - (time.time() - run_start)
+			if time_budget > 0 and not job['changed'] and job['cost'] > remaining:
+				print(f"{layer_name} deferred to the next run. Expected {job['cost']:.0f}s with {max(remaining, 0):.0f}s left in the time budget.")
+				deferred_list.append(layer_name)
 			else:
-				print(f'Importing {layer_name} - {datetime.now().strftime("%T")}')
-				lyr_dat_dict = get_url_date(url, layer_name)
-				shp_date=lyr_dat_dict[f'{layer_name}.shp']
-				
-				proceed = True
-				if force_import == 0:
-					proceed = check_date(county, layer_type, shp_date)
-				else:
-					print('Forced import is activated.')
-					check_date(county, layer_type, shp_date)
-					proceed = True
-				
-				if proceed == True and layer_name not in omission_list:
-					cmd = format_cmd(layer_name)
-					subprocess.Popen(f'cd {db_ws_loc} && {cmd}', shell=True).wait()
-
-					try:
-						sql = f"select count(*) from \"{layer_name}\""
-						fc = run_sql(getframeinfo(currentframe()).lineno, sql=sql, layer_name=layer_name)[0]
-						print(f'{layer_name} feature count: {fc}')
-						if fc < 1:
-							print(f'{layer_name} table is empty.')
-							empty_tables_list.append(layer_name)
-						else:
-							spatial_check(county, layer_type, layer_name)
-					except Exception as e:
-						print(f"Import for {layer_name} failed.")
-						omission_list.append(layer_name)
-						errorcatch(e, {getframeinfo(currentframe()).lineno})
-
-
-					if (county in shp_counties) * (layer_name not in empty_tables_list) * (layer_name not in geom_mismatch_list) == 1:
-						dest = f'{db_ws_loc}/SHPs/{layer_name}'
-
-						if os.path.exists(dest):
-							shutil.rmtree(dest)                  
-						
-						# Extracting SHPs with corrected SRS
-						print(f'Extracting {layer_name} from {db}.')
-						cmd = f'ogr2ogr -f "Esri shapefile" "{dest}" "{db_ws_loc}/{db}" "{layer_name}"'
-						print(cmd)
-						subprocess.Popen(f'{cmd}', shell=True).wait()
-						
-						print('Collecting resulting filenames.')
-						filelist = []
-						for (dirpath, dirnames, filenames) in os.walk(dest):
-							print('filenames: ' + str(filenames))
-							filelist.extend(filenames)
-							print('filelist: ' + str(filelist))
-							break
-
-						# update timestamp on file to reflect the original then pass into zipfile.
-						print('Updating timestamps on files and sending to zip.')
-						with ZipFile(f'{dest}.zip', 'w') as zipObj:
-							for file in filelist:
-								update_timestamp(lyr_dat_dict[f'{file}'], f'{dest}/{file}')
-								zipObj.write(f'{dest}/{file}', file)	# The second argument being the name to save it under.
-						zipObj.close()
-						print(shp_date)
-						print(f'{dest}.zip')
-						
-						update_timestamp(shp_date, f'{dest}.zip')
-						shutil.rmtree(dest)
-				
-			print('-----')
+				start = time.time()
+				imported = import_layer(job['county'], job['layer_type'], job['url'])
+				record_run(job, imported, time.time() - start)
+
+		print('-----')
+
+
+# Downloads a single layer if it is newer than the one on hand and manages the file manipulations. Returns True if the
+# layer was imported, False if it was up to date or failed before the import.
+def import_layer(county, layer_type, url):
+	layer_name = f'{county}_{layer_type}'
+	print(f'Importing {layer_name} - {datetime.now().strftime("%T")}')
+	lyr_dat_dict, content_hash = get_url_date(url, layer_name)
+	shp_date=lyr_dat_dict[f'{layer_name}.shp']
+	
+	proceed = True
+	if force_import == 0:
+		proceed = check_date(county, layer_type, shp_date, content_hash)
+	else:
+		print('Forced import is activated.')
+		check_date(county, layer_type, shp_date, content_hash)
+		proceed = True
+	
+	imported = proceed == True and layer_name not in omission_list
+	if imported:
+		cmd = format_cmd(layer_name, inproc=use_inproc_reproject())
+		subprocess.Popen(f'cd {db_ws_loc} && {cmd}', shell=True).wait()
+		if use_inproc_reproject():
+			reproject_layer(layer_name)
+
+		try:
+			sql = f"select count(*) from \"{layer_name}\""
+			fc = run_sql(getframeinfo(currentframe()).lineno, sql=sql, layer_name=layer_name)[0]
+			print(f'{layer_name} feature count: {fc}')
+			if fc < 1:
+				print(f'{layer_name} table is empty.')
+				empty_tables_list.append(layer_name)
+			else:
+				spatial_check(county, layer_type, layer_name)
+		except Exception as e:
+			print(f"Import for {layer_name} failed.")
+			omission_list.append(layer_name)
+			errorcatch(e, {getframeinfo(currentframe()).lineno})
+
+		# Only a good import is recorded, so a failed, empty or misaligned layer is imported again next time even if
+		# the state re-publishes the same content.
+		if content_hash != '' and layer_name not in omission_list + empty_tables_list + geom_mismatch_list:
+			save_content_hash(layer_name, content_hash)
+
+
+		if (county in shp_counties) * (layer_name not in empty_tables_list) * (layer_name not in geom_mismatch_list) == 1:
+			dest = f'{db_ws_loc}/SHPs/{layer_name}'
+
+			if os.path.exists(dest):
+				shutil.rmtree(dest)                  
+			
+			# Extracting SHPs with corrected SRS
+			print(f'Extracting {layer_name} from {db}.')
+			cmd = f'ogr2ogr -f "Esri shapefile" "{dest}" "{db_ws_loc}/{db}" "{layer_name}"'
+			print(cmd)
+			subprocess.Popen(f'{cmd}', shell=True).wait()
+			
+			print('Collecting resulting filenames.')
+			filelist = []
+			for (dirpath, dirnames, filenames) in os.walk(dest):
+				print('filenames: ' + str(filenames))
+				filelist.extend(filenames)
+				print('filelist: ' + str(filelist))
+				break
+
+			# update timestamp on file to reflect the original then pass into zipfile.
+			print('Updating timestamps on files and sending to zip.')
+			with ZipFile(f'{dest}.zip', 'w') as zipObj:
+				for file in filelist:
+					update_timestamp(lyr_dat_dict[f'{file}'], f'{dest}/{file}')
+					zipObj.write(f'{dest}/{file}', file)	# The second argument being the name to save it under.
+			zipObj.close()
+			print(shp_date)
+			print(f'{dest}.zip')
+			
+			update_timestamp(shp_date, f'{dest}.zip')
+			shutil.rmtree(dest)
+
+	return imported
 
 
 # Checks the validity of a url. Early catch for unavailable URLs. Returns None if invalid.
 def url_check(url):
-	request = requests.get(url)
-	if request.status_code == 200:
+	try:
+		response = http_request('HEAD', url)
+	except Exception as e:
+		errorcatch(e, {getframeinfo(currentframe()).lineno})
+		return None
+	if response.status_code == 200:
 		return url
 	else:
 		return None
 
 
-# Retrieves, stores the publishing date of each file in the web.zip file and returns them in a python dictionary.
+# Makes a web request through the shared http_session, retrying connection errors, timeouts and 429/5xx responses with
+# exponential backoff and jitter. No more than http_max_per_host requests run against a host at once. If dest (an open
+# binary file) is given, a successful response body is streamed into it, otherwise it is read into response.content.
+# Returns the response, or raises the last error once the retries are used up.
+def http_request(method, url, dest=None, **kwargs):
+	host = urlparse(url).netloc
+	with http_lock:
+		if host not in http_host_slots:
+			http_host_slots[host] = threading.BoundedSemaphore(http_max_per_host)
+		slot = http_host_slots[host]
+
+	for attempt in range(http_retries + 1):
+		start = time.time()
+		received = 0
+		try:
+			with slot:
+				response = http_session.request(method, url, timeout=http_timeout, stream=True, **kwargs)
+				if response.status_code == 429 or response.status_code >= 500:
+					response.close()
+					raise requests.HTTPError(f'{response.status_code} {response.reason} for {url}', response=response)
+				if dest is not None and response.status_code == 200:
+					dest.seek(0)
+					dest.truncate()
+					for chunk in response.iter_content(chunk_size=1024 * 1024):
+						dest.write(chunk)
+						received += len(chunk)
+					dest.flush()
+					dest.seek(0)
+				else:
+					received = len(response.content)
+			with http_lock:
+				http_metrics['requests'] += 1
+				http_metrics['bytes'] += received
+				http_metrics['seconds'] += time.time() - start
+			return response
+		except (requests.ConnectionError, requests.Timeout, requests.HTTPError, requests.exceptions.ChunkedEncodingError) as e:
+			with http_lock:
+				http_metrics['requests'] += 1
+				http_metrics['bytes'] += received
+				http_metrics['seconds'] += time.time() - start
+				if attempt < http_retries:
+					http_metrics['retries'] += 1
+				else:
+					http_metrics['failures'] += 1
+			if attempt == http_retries:
+				raise
+			delay = random.uniform(0, http_backoff * 2 ** attempt)
+			print(f'{method} {url} failed ({type(e).__name__}). Retrying in {delay:.1f}s.')
+			time.sleep(delay)
+
+
+# Like url_check, but only asks for the headers. Returns the url (None if invalid) along with the Content-Length and
+# Last-Modified headers used by schedule_layers.
+def url_head(url):
+	try:
+		response = http_request('HEAD', url)
+	except Exception as e:
+		print(f'Header request for {url} failed.')
+		errorcatch(e, {getframeinfo(currentframe()).lineno})
+		return None, 0, ''
+	if response.status_code != 200:
+		return None, 0, ''
+	return url, int(response.headers.get('Content-Length', 0)), response.headers.get('Last-Modified', '')
+
+
+# Returns the run history as a python dictionary keyed by layer_name. Each layer's download size, Last-Modified header
+# and how long it took to import (or just to check, when it was up to date) are kept for the next run's schedule.
+def get_run_history():
+	history = {}
+	if os.path.exists(run_history_file):
+		try:
+			with open(run_history_file, 'r') as history_file:
+				history = json.load(history_file)
+		except Exception as e:
+			print('Run history unreadable. Scheduling from download sizes only.')
+			errorcatch(e, {getframeinfo(currentframe()).lineno})
+	else:
+		print('Run history not found. Scheduling from download sizes only.')
+	return history
+
+
+# Orders the county_list and layer_types work by expected cost so the nightly window is spent where it matters:
+#	1. Layers likely to have changed (new Last-Modified or Content-Length, or never seen before) go first.
+#	2. Within each group, the longest expected layers go first so a big county like FRA or CUY doesn't start last.
+# Expected cost is the layer's last import time scaled by its current Content-Length, its last check time if it is
+# probably unchanged, or the average seconds per byte of past imports when the layer has no history yet.
+# GeoPackage takes one writer at a time, so the jobs are worked through one after another in this order.
+def schedule_layers():
+	history = get_run_history()
+	run_history.update(history)
+	rates = [h['import_secs'] / h['content_length'] for h in history.values() if h['import_secs'] and h['content_length']]
+	secs_per_byte = sum(rates) / len(rates) if len(rates) > 0 else default_secs_per_byte
+
+	print(f'Scheduling layers - {datetime.now().strftime("%T")}')
+	jobs = []
+	for county in county_list:
+		for layer_type in layer_types:
+			layer_name = f'{county}_{layer_type}'
+			url, content_length, last_modified = url_head(f'http://gis3.oit.ohio.gov/LBRS/_downloads/{layer_name}.zip')
+			past = history.get(layer_name, {'content_length': 0, 'last_modified': '', 'import_secs': None, 'check_secs': None})
+
+			changed = force_import == 1 or last_modified == '' or past['last_modified'] != last_modified or past['content_length'] != content_length
+
+			if past['import_secs'] and past['content_length']:
+				import_cost = past['import_secs'] * content_length / past['content_length']
+			else:
+				import_cost = content_length * secs_per_byte
+
+			if changed or not past['check_secs']:
+				cost = import_cost
+			else:
+				cost = past['check_secs']
+
+			jobs.append({'county': county, 'layer_type': layer_type, 'layer_name': layer_name, 'url': url,
+				'content_length': content_length, 'last_modified': last_modified, 'changed': changed, 'cost': cost,
+				'import_secs': past['import_secs'], 'check_secs': past['check_secs']})
+
+	jobs.sort(key=lambda job: (not job['changed'], -job['cost']))
+	for job in jobs:
+		print(f"{job['layer_name']}: {'likely changed' if job['changed'] else 'probably unchanged'}, ~{job['cost']:.0f}s")
+	return jobs
+
+
+# Saves how long a layer took to the run history file. Failed layers don't keep their Last-Modified so they are seen as
+# changed next run.
+def record_run(job, imported, secs):
+	layer_name = job['layer_name']
+	run_history[layer_name] = {
+		'content_length': job['content_length'],
+		'last_modified': '' if layer_name in omission_list else job['last_modified'],
+		'import_secs': round(secs, 1) if imported else job['import_secs'],
+		'check_secs': job['check_secs'] if imported else round(secs, 1),
+		'last_run': datetime.now().strftime('%F %T'),
+	}
+	with open(f'{run_history_file}.tmp', 'w') as history_file:
+		json.dump(run_history, history_file, indent=1, sort_keys=True)
+	os.replace(f'{run_history_file}.tmp', run_history_file)
+
+
+# Retrieves, stores the publishing date of each file in the web.zip file and returns them in a python dictionary along
+# with the content hash of the layer (see get_content_hash).
 def get_url_date(url, layer_name):
 	# Get dates from top-level files contained in online zip file.
 	
-	open_url = request.urlopen(url)
 	print(url)
 
 	lyr_dat_dict = {}
+	content_hash = ''
 	try:
-		with open_url as zipurl:
-			with ZipFile(BytesIO(zipurl.read())) as zfile:
+		with TemporaryFile() as zipurl:
+			http_request('GET', url, dest=zipurl)
+			with ZipFile(zipurl) as zfile:
 				for info in zfile.infolist():
 					if info.filename.startswith(layer_name) or info.filename.startswith('ALL_ADD'):
 						print(info.filename)
@@ -457,14 +814,57 @@ def get_url_date(url, layer_name):
 							# slicing off the .extension from the ALL_ADD* as we know it's been miss named
 							lyr_dat_dict[f'{layer_name}{info.filename[7:]}'] = lyr_dat_dict[info.filename]
 							del lyr_dat_dict[info.filename]
+				content_hash = get_content_hash(zfile, layer_name)
 	except Exception as e:
 		print(f'Error getting url dates.')
 		errorcatch(e, {getframeinfo(currentframe()).lineno})
-	return lyr_dat_dict
+	return lyr_dat_dict, content_hash
+
+
+# Fingerprints the .shp, .dbf and .prj files in the web.zip. The state frequently re-zips unchanged data with a new
+# timestamp, so check_date compares this before treating a new date as an update.
+# The dbf header carries its own last-update date (bytes 1-3), which is blanked out so a re-export of the same records
+# still matches.
+def get_content_hash(zfile, layer_name):
+	members = {}
+	for info in zfile.infolist():
+		ext = info.filename[-4:].lower()
+		if (info.filename.startswith(layer_name) or info.filename.startswith('ALL_ADD')) and ext in ('.shp', '.dbf', '.prj'):
+			members[ext] = info.filename
+
+	if '.shp' not in members:
+		return ''
+
+	content_hash = hashlib.sha256()
+	for ext in sorted(members):
+		member_hash = hashlib.sha256()
+		with zfile.open(members[ext]) as member:
+			chunk = member.read(1024 * 1024)
+			if ext == '.dbf':
+				chunk = chunk[:1] + bytes(3) + chunk[4:]
+			while chunk:
+				member_hash.update(chunk)
+				chunk = member.read(1024 * 1024)
+		content_hash.update(f'{ext}:{member_hash.hexdigest()};'.encode())
+	print(f'Content hash: {content_hash.hexdigest()}')
+	return content_hash.hexdigest()
+
+
+# Creates the shp_hashes table if the db predates it. Keeps the content hash of each layer as last imported.
+def prep_shp_hashes():
+	sql = "CREATE TABLE IF NOT EXISTS shp_hashes (layer_name text primary key, content_hash text);"
+	run_sql(getframeinfo(currentframe()).lineno, sql=sql)
+
+
+# Records the content hash of a successfully imported layer for check_date.
+def save_content_hash(layer_name, content_hash):
+	sql = f"INSERT OR REPLACE INTO shp_hashes (layer_name, content_hash) VALUES ('{layer_name}', '{content_hash}');"
+	run_sql(getframeinfo(currentframe()).lineno, sql=sql)
 
 
-# Checks the shp_date table to see if the file on-hand is current with the one on the web.
-def check_date(county,layer_type, shp_date):
+# Checks the shp_date table to see if the file on-hand is current with the one on the web. If only the date differs and
+# the content hash matches the one on hand, records the new date without calling for an import.
+def check_date(county,layer_type, shp_date, content_hash=''):
 	# 1. TRY Pull url date (keeping in mind some counties are unavailable)
 	layer_name = f'{county}_{layer_type}'
 	try:
@@ -491,12 +891,24 @@ def check_date(county,layer_type, shp_date):
 			return False
 		else:
 			# 3b. If different,
-			updates_list.append(f'{layer_name}')
-			# 3b1. update the _package_date table 
+			# 3b1. check whether the content actually changed
+			sql = f"select content_hash from shp_hashes where layer_name = '{layer_name}';"
+			archive_hash = run_sql(getframeinfo(currentframe()).lineno, sql=sql)[1]
+			print(f'Web.shp Hash: {content_hash}')
+			print(f'Archive Hash: {archive_hash}')
+			is_dupe = force_import == 0 and content_hash != '' and str(archive_hash) == content_hash
+			if is_dupe:
+				print(f'{layer_name} re-published without changes.')
+				dedupe_list.append(f'{layer_name}')
+			else:
+				updates_list.append(f'{layer_name}')
+			# 3b2. update the _package_date table 
 			print('Updating archive date.')
 			sql = f"UPDATE shp_dates SET \"{layer_type}_shp_date\" = '{shp_date}' WHERE \"COUNTY_CD\"='{county}';"
 			run_sql(getframeinfo(currentframe()).lineno, sql=sql)[0]
-			# 3b2. update the layer
+			if is_dupe:
+				return False
+			# 3b3. update the layer (import_layer records the new content hash once the import checks out)
 			print(f'Updating {layer_name}')
 			return True
 	
@@ -510,7 +922,9 @@ def check_date(county,layer_type, shp_date):
 # Formats the ogr2ogr command to:
 #	Modify and convert the spatial references of all assigned layers for consistency.
 #	Download the assigned layer and store it in the db.gpkg
-def format_cmd(layer_name, f='GPKG', dest=db):
+# With inproc set, layers needing reprojection are instead assigned their source SRS and stored in a {layer_name}_src
+# table for reproject_layer.
+def format_cmd(layer_name, f='GPKG', dest=db, inproc=False, src=None):
 	if layer_name in crs3734:
 		s_srs = '3734'
 		t_code = ''
@@ -525,16 +939,272 @@ def format_cmd(layer_name, f='GPKG', dest=db):
 		s_srs = '32123'
 		t_code = f'-t_srs EPSG:{t_srs} '
 
+	nln = layer_name
+	mode = '-append'
+	if inproc and t_code != '':
+		# Only the layers with an -s_srs override get their SRS assigned. The rest keep the SRS from their own prj.
+		if '-s_srs' in t_code:
+			t_code = f'-a_srs EPSG:{s_srs} '
+		else:
+			t_code = ''
+		nln = f'{layer_name}_src'
+		mode = '-overwrite'
+
 	if limit_features > 0:
 		lmt = f'-limit {limit_features} '
 	else:
 		lmt = ''
 
-	cmd = r'ogr2ogr -f "' + f +'" -update -append -gt 20000 -skipfailures -unsetFieldWidth -nln "' + layer_name + r'" -preserve_fid -geomfield "geom" ' + lmt + t_code + dest + r' "/vsizip/vsicurl/http://gis3.oit.ohio.gov/LBRS/_downloads/' + layer_name + r'.zip"'
+	if src is None:
+		src = f'/vsizip/vsicurl/http://gis3.oit.ohio.gov/LBRS/_downloads/{layer_name}.zip'
+
+	cmd = r'ogr2ogr ' + gdal_http_config + r' -f "' + f +'" -update ' + mode + ' -gt 20000 -skipfailures -unsetFieldWidth -nln "' + nln + r'" -preserve_fid -geomfield "geom" ' + lmt + t_code + dest + r' "' + src + r'"'
 	print(cmd)
 	return cmd
 
 
+# Whether layers are reprojected by reproject_layer rather than by ogr2ogr.
+def use_inproc_reproject():
+	return inproc_reproject == 1 and np is not None
+
+
+# Returns the coordinate transformation from the given SRS to t_srs, building it only the first time each source SRS
+# is seen in the run. Setting up the PROJ pipeline is a large share of the cost for smaller layers.
+# Returns None if there is no source SRS to transform from.
+def get_transform(s_srs):
+	if s_srs is None:
+		return None
+	key = s_srs.GetAuthorityCode(None) or s_srs.ExportToWkt()
+	if key not in transform_cache:
+		src = s_srs.Clone()
+		dst = osr.SpatialReference()
+		dst.ImportFromEPSG(int(t_srs))
+		# GDAL 3+ otherwise follows the authority axis order, which is not what's stored in the layers.
+		if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+			src.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+			dst.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+		transform_cache[key] = osr.CoordinateTransformation(src, dst)
+	return transform_cache[key]
+
+
+# Walks a little-endian ISO WKB geometry from offset and adds (offset, point count, coordinate dimension, has z) to
+# blocks for each run of coordinates in it. Returns the offset just past the geometry.
+def wkb_coord_blocks(wkb, offset, blocks):
+	gtype = struct.unpack_from('<I', wkb, offset + 1)[0]
+	offset += 5
+	base = gtype % 1000
+	has_z = gtype // 1000 in (1, 3)
+	dims = 2 + (gtype // 1000 in (1, 2)) + 2 * (gtype // 1000 == 3)
+
+	if base == 1:
+		# Point
+		blocks.append((offset, 1, dims, has_z))
+		return offset + 8 * dims
+	elif base in (2, 8):
+		# LineString, CircularString
+		count = struct.unpack_from('<I', wkb, offset)[0]
+		blocks.append((offset + 4, count, dims, has_z))
+		return offset + 4 + 8 * dims * count
+	elif base in (3, 17):
+		# Polygon, Triangle
+		rings = struct.unpack_from('<I', wkb, offset)[0]
+		offset += 4
+		for i in range(rings):
+			count = struct.unpack_from('<I', wkb, offset)[0]
+			blocks.append((offset + 4, count, dims, has_z))
+			offset += 4 + 8 * dims * count
+		return offset
+	else:
+		# Multi*, GeometryCollection, CompoundCurve, CurvePolygon, MultiCurve, MultiSurface, PolyhedralSurface, TIN
+		count = struct.unpack_from('<I', wkb, offset)[0]
+		offset += 4
+		for i in range(count):
+			offset = wkb_coord_blocks(wkb, offset, blocks)
+		return offset
+
+
+# Reprojects the geometries of a batch of features with a single TransformPoints call over all of their coordinates.
+# Each geometry is exported to WKB once, its coordinates are gathered into one NumPy array, transformed, written back
+# into the WKB buffers through NumPy views and rebuilt, so there is no per-vertex work in Python.
+# Returns the new geometries (None where a feature has none) and the positions of features with coordinates that could
+# not be transformed, which are left out as ogr2ogr -skipfailures does.
+def transform_features(feats, transform):
+	geoms = [None] * len(feats)
+	bufs = []
+	views = []
+	owners = []
+	for i, feat in enumerate(feats):
+		geom = feat.GetGeometryRef()
+		if geom is None:
+			continue
+		buf = bytearray(geom.ExportToIsoWkb(ogr.wkbNDR))
+		blocks = []
+		wkb_coord_blocks(buf, 0, blocks)
+		bufs.append((i, buf))
+		for offset, count, dims, has_z in blocks:
+			if count > 0:
+				views.append((np.frombuffer(buf, dtype='<f8', count=count * dims, offset=offset).reshape(count, dims), has_z))
+				owners.append(np.full(count, i))
+	if len(views) < 1:
+		return [feat.GetGeometryRef() for feat in feats], set()
+
+	coords = np.concatenate([np.column_stack((view[:, :2], view[:, 2] if has_z else np.zeros(len(view)))) for view, has_z in views])
+	owners = np.concatenate(owners)
+
+	try:
+		result = transform.TransformPoints(coords)
+	except (TypeError, ValueError):
+		# Older GDAL only takes a sequence of tuples.
+		result = transform.TransformPoints(coords.tolist())
+	result = np.asarray(result, dtype=float)[:, :3]
+
+	# Empty points are NaN going in, so only coordinates that were good before and bad after count as failures.
+	bad = np.isfinite(coords[:, :2]).all(axis=1) & ~np.isfinite(result[:, :2]).all(axis=1)
+	failed = set(owners[bad].tolist())
+
+	offset = 0
+	for view, has_z in views:
+		count = len(view)
+		view[:, :2] = result[offset:offset + count, :2]
+		if has_z:
+			view[:, 2] = result[offset:offset + count, 2]
+		offset += count
+
+	for i, buf in bufs:
+		if i not in failed:
+			geoms[i] = ogr.CreateGeometryFromWkb(bytes(buf))
+	return geoms, failed
+
+
+# Reprojects the {layer_name}_src table left by format_cmd into the layer_name table in t_srs, appending to it and
+# keeping FIDs as ogr2ogr would, then drops the _src table. Returns the number of features written, the seconds taken
+# and how many of those seconds were spent in transform_features.
+# Does nothing if there is no _src table.
+def reproject_layer(layer_name, dest=db):
+	filename = f'{db_ws_loc}/{dest}'
+	file = driver.Open(filename, 1)
+	src_lyr = file.GetLayerByName(f'{layer_name}_src')
+	if src_lyr is None:
+		file = None
+		return 0, 0.0, 0.0
+
+	print(f'Reprojecting {layer_name} - {datetime.now().strftime("%T")}')
+	start = time.time()
+	transform = get_transform(src_lyr.GetSpatialRef())
+	if transform is None:
+		# Same outcome as ogr2ogr -t_srs on a layer without a prj: nothing is imported.
+		print(f'ERROR: {layer_name} has no source SRS to reproject from.')
+		src_lyr = None
+		delete_layer(file, f'{layer_name}_src')
+		file = None
+		return 0, time.time() - start, 0.0
+
+	dst_lyr = file.GetLayerByName(layer_name)
+	if dst_lyr is None:
+		dst_srs = osr.SpatialReference()
+		dst_srs.ImportFromEPSG(int(t_srs))
+		dst_lyr = file.CreateLayer(layer_name, dst_srs, src_lyr.GetGeomType(), options=['GEOMETRY_NAME=geom'])
+		src_defn = src_lyr.GetLayerDefn()
+		for i in range(src_defn.GetFieldCount()):
+			dst_lyr.CreateField(src_defn.GetFieldDefn(i))
+	dst_defn = dst_lyr.GetLayerDefn()
+
+	written = 0
+	failed = 0
+	transform_secs = 0.0
+	file.StartTransaction()
+	feats = []
+	src_lyr.ResetReading()
+	feat = src_lyr.GetNextFeature()
+	while feat is not None or len(feats) > 0:
+		if feat is not None:
+			feats.append(feat)
+		if len(feats) >= reproject_batch or (feat is None and len(feats) > 0):
+			transform_start = time.time()
+			geoms, bad = transform_features(feats, transform)
+			transform_secs += time.time() - transform_start
+			failed += len(bad)
+			for i, src_feat in enumerate(feats):
+				if i in bad:
+					continue
+				dst_feat = ogr.Feature(dst_defn)
+				dst_feat.SetFrom(src_feat)
+				if geoms[i] is not None:
+					dst_feat.SetGeometry(geoms[i])
+				dst_feat.SetFID(src_feat.GetFID())
+				# Skipping failures as ogr2ogr -skipfailures does.
+				if dst_lyr.CreateFeature(dst_feat) == 0:
+					written += 1
+				else:
+					failed += 1
+			feats = []
+		if feat is not None:
+			feat = src_lyr.GetNextFeature()
+	file.CommitTransaction()
+
+	src_lyr = None
+	delete_layer(file, f'{layer_name}_src')
+	file = None
+
+	elapsed = time.time() - start
+	print(f'{layer_name}: {written} features reprojected ({failed} failed) in {elapsed:.1f}s.')
+	return written, elapsed, transform_secs
+
+
+# Deletes a layer from an open datasource by name.
+def delete_layer(file, layer_name):
+	for i in range(file.GetLayerCount()):
+		if file.GetLayer(i).GetName() == layer_name:
+			file.DeleteLayer(i)
+			break
+
+
+# Compares the cost of reprojecting a layer (e.g. a large ADDS layer) by ogr2ogr against reproject_layer. The zip is
+# downloaded once so the network doesn't skew the results. Each path is run end to end into its own scratch GeoPackage:
+#	1. ogr2ogr import with reprojection, as format_cmd does with inproc_reproject = 0.
+#	2. ogr2ogr import without reprojection into the _src table, then reproject_layer, as with inproc_reproject = 1.
+# The time reproject_layer spends in transform_features alone is also shown.
+def benchmark_reprojection(layer_name):
+	print(f'Benchmarking reprojection of {layer_name} - {datetime.now().strftime("%T")}')
+	if np is None:
+		print('numpy is required for in-process reprojection.')
+		return
+	if layer_name in crs3734:
+		print(f'{layer_name} is already in EPSG:{t_srs}. Nothing to reproject.')
+		return
+
+	bench_zip = f'{db_ws_loc}/bench_{layer_name}.zip'
+	with open(bench_zip, 'wb') as benchzip:
+		http_request('GET', f'http://gis3.oit.ohio.gov/LBRS/_downloads/{layer_name}.zip', dest=benchzip)
+
+	timings = {}
+	for bench_db, inproc in (('bench_ogr2ogr.gpkg', False), ('bench_inproc.gpkg', True)):
+		if os.path.exists(f'{db_ws_loc}/{bench_db}'):
+			os.remove(f'{db_ws_loc}/{bench_db}')
+		driver.CreateDataSource(f'{db_ws_loc}/{bench_db}')
+		cmd = format_cmd(layer_name, dest=bench_db, inproc=inproc, src=f'/vsizip/{bench_zip}')
+		start = time.time()
+		subprocess.Popen(f'cd {db_ws_loc} && {cmd}', shell=True).wait()
+		timings[inproc] = time.time() - start
+
+	# Starting from a fresh run so the cached transformation setup is counted.
+	transform_cache.clear()
+	fc, reproject_secs, transform_secs = reproject_layer(layer_name, dest='bench_inproc.gpkg')
+	ogr2ogr_secs = timings[False]
+	inproc_secs = timings[True] + reproject_secs
+
+	print('')
+	print(f'{layer_name}: {fc} features')
+	print(f'ogr2ogr with -t_srs:                  {ogr2ogr_secs:.2f}s, {1000 * 1000 * ogr2ogr_secs / max(fc, 1):.1f}us per feature')
+	print(f'ogr2ogr to _src plus reproject_layer: {inproc_secs:.2f}s, {1000 * 1000 * inproc_secs / max(fc, 1):.1f}us per feature')
+	print(f'   ogr2ogr to _src:                   {timings[True]:.2f}s')
+	print(f'   reproject_layer:                   {reproject_secs:.2f}s')
+	print(f'   of which transform_features:       {transform_secs:.2f}s, {1000 * 1000 * transform_secs / max(fc, 1):.1f}us per feature')
+
+	for bench_file in (bench_zip, f'{db_ws_loc}/bench_ogr2ogr.gpkg', f'{db_ws_loc}/bench_inproc.gpkg'):
+		os.remove(bench_file)
+
+
 # Runs SQL commands through the db.gdb throughout the script.
 # 	1. To create the timestamp table. 
 #	2. Update the timestamp table as needed. 
@@ -639,6 +1309,94 @@ def zip_files(filelist, dest):
 	zipObj.close()
 
 
+# Compacts the workspace db before publishing. Repeated -append imports and table replacements leave free pages,
+# fragmented R-trees and stale statistics behind, which slow down both the archive copy and queries against it.
+# Returns False if a spatial index was lost along the way and the db should not be published.
+def optimize_db():
+	filename = f'{db_ws_loc}/{db}'
+	remaining = time_budget * 60 - (time.time() - run_start)
+	if len(updates_list) < 1:
+		print('No layers were updated. Skipping optimization.')
+		return True
+	if time_budget > 0 and remaining < optimize_reserve * 60:
+		print(f'Only {max(remaining, 0) / 60:.0f} minutes left in the time budget. Skipping optimization.')
+		return True
+
+	print(f'Optimizing {db} - {datetime.now().strftime("%T")}')
+	start = time.time()
+	size_before = os.stat(filename).st_size
+
+	indexes = []
+	try:
+		# Rebuilding the R-trees through GDAL, as the GeoPackage triggers need its spatial SQL functions.
+		file = driver.Open(filename, 1)
+		output = file.ExecuteSQL("SELECT table_name, column_name FROM gpkg_extensions WHERE extension_name = 'gpkg_rtree_index'")
+		feat = output.GetNextFeature()
+		while feat is not None:
+			indexes.append((feat.GetField(0), feat.GetField(1)))
+			feat = output.GetNextFeature()
+		file.ReleaseResultSet(output)
+		for table_name, column_name in indexes:
+			print(f'Rebuilding spatial index on {table_name}.')
+			file.ReleaseResultSet(file.ExecuteSQL(f"SELECT DisableSpatialIndex('{table_name}', '{column_name}')"))
+			file.ReleaseResultSet(file.ExecuteSQL(f"SELECT CreateSpatialIndex('{table_name}', '{column_name}')"))
+			if not has_spatial_index(file, table_name, column_name):
+				print(f'Spatial index on {table_name} missing after the rebuild. Retrying.')
+				file.ReleaseResultSet(file.ExecuteSQL(f"SELECT CreateSpatialIndex('{table_name}', '{column_name}')"))
+				if not has_spatial_index(file, table_name, column_name):
+					raise Exception(f'Unable to re-create the spatial index on {table_name}.')
+		file = None
+
+		con = sqlite3.connect(filename)
+		for table_name, column_name in indexes:
+			rtree = f'rtree_{table_name}_{column_name}'
+			con.execute(f'UPDATE gpkg_contents SET min_x = (SELECT min(minx) FROM "{rtree}"), min_y = (SELECT min(miny) FROM "{rtree}"), max_x = (SELECT max(maxx) FROM "{rtree}"), max_y = (SELECT max(maxy) FROM "{rtree}") WHERE table_name = ?', (table_name,))
+		con.commit()
+		con.execute('ANALYZE')
+		con.commit()
+
+		con.execute(f'PRAGMA page_size = {optimize_page_size}')
+		if os.path.exists(f'{filename}.optimized'):
+			os.remove(f'{filename}.optimized')
+		try:
+			con.execute(f"VACUUM INTO '{filename}.optimized'")
+			con.close()
+			os.replace(f'{filename}.optimized', filename)
+		except sqlite3.OperationalError:
+			# VACUUM INTO needs SQLite 3.27+. Compacting in place does the same, just without the fresh file.
+			con.execute('VACUUM')
+			con.close()
+	except Exception as e:
+		print('Optimization failed.')
+		errorcatch(e, {getframeinfo(currentframe()).lineno})
+		file = driver.Open(filename, 0)
+		if file is None:
+			missing = [table_name for table_name, column_name in indexes]
+		else:
+			missing = [table_name for table_name, column_name in indexes if not has_spatial_index(file, table_name, column_name)]
+		file = None
+		if len(missing) > 0:
+			print(f'ERROR: Spatial indexes lost on {missing}. The db will not be published.')
+			return False
+		print('Continuing with the database as is.')
+		return True
+
+	size_after = os.stat(filename).st_size
+	print(f'{db} optimized from {size_before / (1000 * 1000):.1f}MB to {size_after / (1000 * 1000):.1f}MB in {time.time() - start:.1f}s.')
+	return True
+
+
+# Checks a table in an open GeoPackage still has its R-tree spatial index.
+def has_spatial_index(file, table_name, column_name):
+	output = file.ExecuteSQL(f"SELECT HasSpatialIndex('{table_name}', '{column_name}')")
+	if output is None:
+		return False
+	feat = output.GetNextFeature()
+	has_index = feat is not None and feat.GetField(0) == 1
+	file.ReleaseResultSet(output)
+	return has_index
+
+
 # Transfers files
 def xfer_data(src, dest):
 	print(f'Transferring from {src} to {dest}.')
@@ -663,6 +1421,100 @@ def xfer_data(src, dest):
 		print('File transfer completed')
 
 
+# Publishes the workspace db to the archive location without readers on the share ever seeing a missing or half-written
+# database. The new db is copied beside the live one, verified by checksum and PRAGMA integrity_check, then renamed over
+# the live one in a single step. Returns False, leaving the live db untouched, if the copy doesn't check out.
+def publish_db(src, dest):
+	print(f'Publishing {src} to {dest}.')
+	if src == dest:
+		return True
+	elif os.path.exists(dest) and datetime.fromtimestamp(os.path.getmtime(src)) == datetime.fromtimestamp(os.path.getmtime(dest)):
+		print('No changes made between files. Transfer not needed.')
+		return True
+
+	staged = f'{dest}.staging'
+	if os.path.exists(staged):
+		os.remove(staged)
+	# copy_large_file exits the script on a failed copy. Here that only means the publish failed.
+	try:
+		xfer_data(src, staged)
+	except (Exception, SystemExit) as e:
+		print(f'ERROR: Copy to {staged} failed.')
+		errorcatch(e, {getframeinfo(currentframe()).lineno})
+		if os.path.exists(staged):
+			os.remove(staged)
+		return False
+
+	print(f'Verifying {staged} - {datetime.now().strftime("%T")}')
+	if file_hash(src) != file_hash(staged):
+		print('ERROR: Checksum of the staged copy does not match the workspace db.')
+		os.remove(staged)
+		return False
+	try:
+		con = sqlite3.connect(staged)
+		integrity = con.execute('PRAGMA integrity_check').fetchone()[0]
+		con.close()
+	except Exception as e:
+		errorcatch(e, {getframeinfo(currentframe()).lineno})
+		integrity = 'unreadable'
+	if integrity != 'ok':
+		print(f'ERROR: Integrity check of the staged copy failed: {integrity}')
+		os.remove(staged)
+		return False
+
+	if os.path.exists(dest) and db_generations > 0:
+		keep_generation(dest)
+
+	# On Windows shares, the rename fails while a reader has the file locked. Waiting a little usually clears it.
+	for attempt in range(5):
+		try:
+			os.replace(staged, dest)
+			break
+		except PermissionError as e:
+			print(f'{dest} is in use. Retrying.')
+			errorcatch(e, {getframeinfo(currentframe()).lineno})
+			time.sleep(5 * (attempt + 1))
+	else:
+		print(f'ERROR: Unable to swap in {staged}. The previous db remains published.')
+		return False
+
+	print(f'{dest} published - {datetime.now().strftime("%T")}')
+	return True
+
+
+# Keeps the currently published db in the generations folder beside it, named by its timestamp, and removes all but the
+# newest db_generations. A hard link is used where the share allows it so the live db is never moved or re-copied.
+def keep_generation(dest):
+	gen_dir = f'{os.path.dirname(dest)}/generations'
+	if not os.path.exists(gen_dir):
+		os.mkdir(gen_dir)
+	stem, ext = os.path.splitext(os.path.basename(dest))
+	gen = f'{gen_dir}/{stem}_{datetime.fromtimestamp(os.path.getmtime(dest)).strftime("%Y%m%d_%H%M%S")}{ext}'
+
+	if not os.path.exists(gen):
+		print(f'Keeping prior generation as {gen}.')
+		try:
+			os.link(dest, gen)
+		except OSError:
+			shutil.copy2(dest, gen)
+
+	gens = sorted(f for f in os.listdir(gen_dir) if f.startswith(f'{stem}_') and f.endswith(ext))
+	for old_gen in gens[:-db_generations]:
+		print(f'Removing old generation {old_gen}.')
+		os.remove(f'{gen_dir}/{old_gen}')
+
+
+# Returns the sha256 of a file, read in 10MB chunks.
+def file_hash(filename):
+	sha = hashlib.sha256()
+	with open(filename, 'rb') as f:
+		chunk = f.read(10 * 1000 * 1000)
+		while chunk:
+			sha.update(chunk)
+			chunk = f.read(10 * 1000 * 1000)
+	return sha.hexdigest()
+
+
 # From https://lukelogbook.tech/2018/01/25/merging-two-folders-in-python/, but using copy2 to retain metadata instead.
 # As copytree will not replace an existing folder, this merges one folder into another including subfolders
 def mergefolders(root_src_dir, root_dst_dir):
@@ -757,7 +1609,10 @@ def copy_large_file(src, dst):
 print("Begin OGRIP LBRS data download - " + datetime.now().strftime("%F %T"))
 print('')
 
-if prj_only > 0 or raw_files_only > 0:
+if bench_reproject != '':
+	benchmark_reprojection(bench_reproject)
+
+elif prj_only > 0 or raw_files_only > 0:
 	get_src_data()
 
 else:
@@ -767,15 +1622,29 @@ else:
 
 	# To check if all items in a list of elements are present in a master list: all(item in mlist for item in elist)
 	if use_arch_db > 0 and len(geom_mismatch_list) <1 and len(empty_tables_list) < 1 and (all(item in anticipated_omissions for item in omission_list) or len(omission_list) < 1):
-		xfer_data(src=f'{db_ws_loc}/{db}', dest=f'{db_arch_loc}/{db}')
-		xfer_data(src=f'{db_ws_loc}/SHPs', dest=f'{db_arch_loc}/SHPs')
-		clean_workspace()
+		# Re-published but unchanged layers only moved a date in shp_dates. That goes out with the next real update, as
+		# the next run dedupes them again by hash, rather than re-publishing the whole db for it.
+		if len(updates_list) < 1 and force_import == 0 and os.path.exists(f'{db_arch_loc}/{db}'):
+			print('No layers were updated. Transfer to archive not needed.')
+			clean_workspace()
+		else:
+			if optimize_gpkg == 1 and not optimize_db():
+				print('Optimization left the db incomplete. Transfer to archive halted.')
+			elif publish_db(src=f'{db_ws_loc}/{db}', dest=f'{db_arch_loc}/{db}'):
+				xfer_data(src=f'{db_ws_loc}/SHPs', dest=f'{db_arch_loc}/SHPs')
+				clean_workspace()
+			else:
+				# prep_workspace starts the next run from the archive db, so the workspace db is replaced either way.
+				print('Publish failed. The archive db was left as it was; the next run starts from it and imports the updated layers again.')
 	elif use_arch_db > 0:
 		print('Update incomplete. Transfer to archive halted.')
 
 print('')
 
 print('Updates were found for the following: %s' % updates_list)
+
+if len(dedupe_list) > 0:
+	print('The following were re-published without changes and were not re-imported: %s' % dedupe_list)
 				      
 if len(omission_list) > 0:
 	print('The following layers failed: %s' % omission_list)
@@ -792,6 +1661,11 @@ if len(geom_mismatch_list) > 0:
 if len(missing_src_list) > 0:
 	print('The following sources were not available: %s' % missing_src_list)
 
+print('Web requests: {requests} ({retries} retried, {failures} failed), {mb:.1f}MB in {seconds:.0f}s'.format(mb=http_metrics['bytes'] / (1000 * 1000), **http_metrics))
+
+if len(deferred_list) > 0:
+	print('The following layers were deferred to the next run to stay within the time budget: %s' % deferred_list)
+
 print('')
 print("Download completed - " + datetime.now().strftime("%F %T"))
 
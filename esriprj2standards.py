@@ -1,9 +1,22 @@
 #! /usr/bin/env python
 # Slightly modified for Python3 and cleaner output from https://gis.stackexchange.com/a/7615
 
+import argparse
+import csv
+import hashlib
+import json
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from zipfile import ZipFile
 from osgeo import osr
 
+# Identified results are stored here, keyed by the sha256 of the prj contents, so a prj already seen on an earlier run
+# is never handed to AutoIdentifyEPSG again.
+default_cache = 'esriprj2standards_cache.json'
+
+fieldnames = ['path', 'wkt', 'proj4', 'epsg', 'confidence', 'error']
+
 def esriprj2standards(shapeprj_path):
    prj_file = open(shapeprj_path, 'r')
    prj_txt = prj_file.read()
@@ -23,7 +36,124 @@ def esriprj2standards(shapeprj_path):
    print('EPSG is:')
    print(srs.GetAuthorityCode(None))
 
-esriprj2standards(sys.argv[1])
+# Same conversion as above, but returns the results instead of printing them. Runs in the worker processes.
+# A prj GDAL can't read comes back with the error noted instead of stopping the rest of the batch.
+def identify_prj(prj_txt):
+   try:
+      return _identify_prj(prj_txt)
+   except Exception as e:
+      return {'wkt': '', 'proj4': '', 'epsg': '', 'confidence': '', 'error': f'{type(e).__name__}: {e}'}
+
+def _identify_prj(prj_txt):
+   srs = osr.SpatialReference()
+   srs.ImportFromESRI([prj_txt])
+   result = {'wkt': srs.ExportToWkt(), 'proj4': srs.ExportToProj4(), 'epsg': '', 'confidence': '', 'error': ''}
+
+   # FindMatches (GDAL 2.3+) ranks candidate EPSG codes with a 0-100 confidence. Older GDAL only has AutoIdentifyEPSG,
+   # which either finds a code or doesn't, so no confidence is reported there.
+   try:
+      matches = srs.FindMatches()
+   except AttributeError:
+      matches = []
+   for match, confidence in matches:
+      if match.GetAuthorityName(None) == 'EPSG':
+         result['epsg'] = match.GetAuthorityCode(None)
+         result['confidence'] = confidence
+         break
+   else:
+      try:
+         srs.AutoIdentifyEPSG()
+      except RuntimeError:
+         pass
+      result['epsg'] = srs.GetAuthorityCode(None) or ''
+   return result
+
+# Walks the given files, directories and zip files and yields (path, prj bytes) for every prj found.
+# Paths inside a zip are reported as archive.zip/member.prj. Both are read as raw bytes so identical prjs hash the same
+# wherever they came from.
+def find_prjs(paths):
+   for path in paths:
+      if os.path.isdir(path):
+         for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            yield from find_prjs(os.path.join(dirpath, f) for f in sorted(filenames) if f.lower().endswith(('.prj', '.zip')))
+      elif path.lower().endswith('.zip'):
+         with ZipFile(path) as zfile:
+            for member in zfile.namelist():
+               if member.lower().endswith('.prj'):
+                  yield f'{path}/{member}', zfile.read(member)
+      elif path.lower().endswith('.prj'):
+         with open(path, 'rb') as prj_file:
+            yield path, prj_file.read()
+
+def load_cache(cache_path):
+   if cache_path and os.path.exists(cache_path):
+      try:
+         with open(cache_path, 'r') as cache_file:
+            return json.load(cache_file)
+      except ValueError:
+         print(f'Cache {cache_path} is unreadable. Starting a new one.', file=sys.stderr)
+   return {}
+
+def save_cache(cache, cache_path):
+   if cache_path:
+      with open(f'{cache_path}.tmp', 'w') as cache_file:
+         json.dump(cache, cache_file, indent=1, sort_keys=True)
+      os.replace(f'{cache_path}.tmp', cache_path)
+
+# Identifies every prj under the given paths. Identical prj contents are only identified once, in a process pool, and
+# the results are kept in the cache file between runs. Returns a list of row dictionaries in the order found.
+def esriprj2standards_batch(paths, cache_path=default_cache, workers=None):
+   found = []
+   for path, prj_bytes in find_prjs(paths):
+      found.append((path, hashlib.sha256(prj_bytes).hexdigest(), prj_bytes.decode('utf-8', 'replace')))
+
+   cache = load_cache(cache_path)
+   todo = {digest: prj_txt for path, digest, prj_txt in found if digest not in cache}
+   if todo:
+      with ProcessPoolExecutor(max_workers=workers) as pool:
+         for digest, result in zip(todo, pool.map(identify_prj, todo.values())):
+            cache[digest] = result
+      save_cache(cache, cache_path)
+
+   print(f'{len(found)} prj files, {len(set(d for p, d, t in found))} unique, {len(todo)} newly identified.', file=sys.stderr)
+   return [dict(cache[digest], path=path) for path, digest, prj_txt in found]
+
+def write_rows(rows, out, fmt='csv'):
+   if fmt == 'json':
+      json.dump(rows, out, indent=1)
+      out.write('\n')
+   else:
+      writer = csv.DictWriter(out, fieldnames=fieldnames, extrasaction='ignore')
+      writer.writeheader()
+      writer.writerows(rows)
+
+def main(argv=None):
+   parser = argparse.ArgumentParser(description='Convert Esri prj files to WKT, Proj4 and EPSG.')
+   parser.add_argument('paths', nargs='+', help='prj files, or directories/zip files to search for prj files')
+   parser.add_argument('-o', '--output', help='write batch results to this file instead of stdout')
+   parser.add_argument('-f', '--format', choices=['csv', 'json'], help='batch output format (default from --output extension, else csv)')
+   parser.add_argument('-j', '--jobs', type=int, help='number of worker processes (default: number of CPUs)')
+   parser.add_argument('--cache', default=default_cache, help=f'results cache file (default: {default_cache}; "" to disable)')
+   args = parser.parse_args(argv)
+
+   # A single prj keeps the original readable output.
+   if len(args.paths) == 1 and os.path.isfile(args.paths[0]) and args.paths[0].lower().endswith('.prj') and not (args.output or args.format):
+      esriprj2standards(args.paths[0])
+      return
+
+   rows = esriprj2standards_batch(args.paths, cache_path=args.cache, workers=args.jobs)
+   fmt = args.format or ('json' if args.output and args.output.lower().endswith('.json') else 'csv')
+   if args.output:
+      with open(args.output, 'w', newline='') as out:
+         write_rows(rows, out, fmt)
+   else:
+      write_rows(rows, sys.stdout, fmt)
+
+if __name__ == '__main__':
+   main()
 
 # Then in cmd/terminal:
-# python3 esriprj2standards.py target.prj
\ No newline at end of file
+# python3 esriprj2standards.py target.prj
+# Or to audit a folder of prjs and/or zip files (e.g. the PRJs folder from Download_OGRIP_LBRS_Layers.py):
+# python3 esriprj2standards.py PRJs/ raw/ -o prj_audit.csv